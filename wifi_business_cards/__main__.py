@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
+import functools
+import io
 import json
+import logging
 from itertools import product
-from typing import Dict, Iterable, List
+from typing import IO, Dict, Iterable, List, NamedTuple, Tuple, Union
 
 import qrcode
 import typer
+from PIL import Image
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 from reportlab.lib.utils import ImageReader
@@ -15,52 +19,88 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 
 app = typer.Typer()
+logger = logging.getLogger(__name__)
 
 WIFI_QR_CODE_FORMAT = "WIFI:T:{encryption_type};S:{ssid};P:{password};;"
 
+# A string to draw: (font, size, x, y, text)
+TextRun = Tuple[str, int, float, float, str]
 
-LABEL_CONFIG = {
-    "label-height": 2 * inch,
-    "label-width": 3.5 * inch,
+# Printed size of the QR code and the resolution it's rasterized at
+QRCODE_SIZE = 0.9 * inch
+QRCODE_DPI = 300
+
+
+class LabelConfig(NamedTuple):
+    label_height: float
+    label_width: float
     # From the left side of the page to the left side of the label
-    "x-start": 0.75 * inch,
+    x_start: float
     # From the bottom of the page to the bottom of the label
-    "y-start": 0.52 * inch,
+    y_start: float
     # How far from the left side of the label to start drawing
-    "x-offset": 0.1 * inch,
+    x_offset: float
     # How far from the top of the label to start drawing
-    "y-offset": 0.1 * inch,
-    "pagesize": letter,
-    "columns": 2,
-    "rows": 5,
-}
+    y_offset: float
+    pagesize: Tuple[float, float]
+    columns: int
+    rows: int
+
+
+LABEL_CONFIG = LabelConfig(
+    label_height=2 * inch,
+    label_width=3.5 * inch,
+    x_start=0.75 * inch,
+    y_start=0.52 * inch,
+    x_offset=0.1 * inch,
+    y_offset=0.1 * inch,
+    pagesize=letter,
+    columns=2,
+    rows=5,
+)
+
+# Card layout, measured from the top-left corner of the label
+TITLE_OFFSET = LABEL_CONFIG.y_offset * 4  # Fudge factor for title string
+TEXT_INDENT = 1.0 * inch  # Text to the right of the QR code
+HEADER_OFFSET = 0.3 * inch
+NEWLINE_OFFSET = 0.2 * inch
+SECTION_OFFSET = 0.5 * inch
+PASSWORD_WIDTH = LABEL_CONFIG.label_width - (2 * LABEL_CONFIG.x_offset)
+
+
+FONTS = (
+    ("normal", "/usr/share/fonts/truetype/ubuntu/Ubuntu-R.ttf"),
+    ("mono", "/usr/share/fonts/truetype/ubuntu/UbuntuMono-R.ttf"),
+    ("bold", "/usr/share/fonts/truetype/ubuntu/Ubuntu-B.ttf"),
+)
 
 
 def register_fonts():
-    pdfmetrics.registerFont(
-        TTFont("normal", "/usr/share/fonts/truetype/ubuntu/Ubuntu-R.ttf")
-    )
-    pdfmetrics.registerFont(
-        TTFont("mono", "/usr/share/fonts/truetype/ubuntu/UbuntuMono-R.ttf")
-    )
-    pdfmetrics.registerFont(
-        TTFont("bold", "/usr/share/fonts/truetype/ubuntu/Ubuntu-B.ttf")
-    )
+    """
+    Registers the fonts used on the cards.  Fonts that are already registered
+    are skipped so the TTF files are only parsed once per process.
+    """
+    registered = set(pdfmetrics.getRegisteredFontNames())
+    for name, path in FONTS:
+        if name not in registered:
+            pdfmetrics.registerFont(TTFont(name, path))
 
 
 def validate_data(data: List) -> None:
-    card_count = 0
-    columns = LABEL_CONFIG["columns"]
-    rows = LABEL_CONFIG["rows"]
+    columns = LABEL_CONFIG.columns
+    rows = LABEL_CONFIG.rows
     max_cards = columns * rows
-    errors = []
 
-    for config in data:
-        if "coords" in config:
-            card_count += len(config["coords"])
-            for row, column in config["coords"]:
-                if (row > rows - 1) or (column > columns - 1):
-                    errors.append(f"ERROR: Invalid coord: {row},{column}")
+    all_coords = [
+        coord for config in data if "coords" in config for coord in config["coords"]
+    ]
+    card_count = len(all_coords)
+
+    errors = [
+        f"ERROR: Invalid coord: {row},{column}"
+        for row, column in all_coords
+        if row >= rows or column >= columns
+    ]
 
     if card_count > max_cards:
         errors.append(
@@ -88,10 +128,37 @@ def get_qrcode_pil(ssid: str, password: str, encryption_type: str = "WPA"):
         ssid=ssid, password=password, encryption_type=encryption_type
     )
 
-    print(qr_text)
-    return qrcode.make(qr_text).get_image()
+    logger.debug("QR payload: %s", qr_text)
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(qr_text)
+    qr.make(fit=True)
+
+    # Pack the module matrix straight into a 1-bit image (MSB first, set bits
+    # are white) instead of having `qrcode` paint every module through PIL.
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    stride = (size + 7) // 8
+    padding = stride * 8 - size
+    packed = b"".join(
+        (int("".join("0" if module else "1" for module in row), 2) << padding).to_bytes(
+            stride, "big"
+        )
+        for row in matrix
+    )
+    image = Image.frombytes("1", (size, size), packed)
+
+    # Rasterize to roughly the printed resolution so ReportLab embeds it as-is
+    # instead of a much larger image.  Scale by a whole number of pixels per
+    # module so every module is the same width; the PDF scales the image to
+    # QRCODE_SIZE anyway.  ReportLab expands 1-bit images to RGB but embeds
+    # "L" images as single-channel DeviceGray.
+    target_px = QRCODE_SIZE * QRCODE_DPI / 72
+    scaled_px = size * max(1, round(target_px / size))
+    return image.resize((scaled_px, scaled_px), Image.NEAREST).convert("L")
 
 
+@functools.lru_cache(maxsize=256)
 def fit_text_to_width(text: str, width: float, font: str, font_size: int = 12) -> int:
     """Calculate an appropriate size for the given dimensions.
 
@@ -104,146 +171,191 @@ def fit_text_to_width(text: str, width: float, font: str, font_size: int = 12) -
     :returns: font_size
     """
     calculated_width = stringWidth(text, font, font_size)
+    if calculated_width <= width:
+        return font_size
 
-    while calculated_width > width:
+    # Text width scales linearly with the font size, so solve for it directly
+    # and only step down if rounding left us a hair too wide.
+    font_size = max(1, int(font_size * width / calculated_width))
+    if font_size > 1 and stringWidth(text, font, font_size) > width:
         font_size -= 1
-        calculated_width = stringWidth(text, font, font_size)
 
     return font_size
 
 
 def draw_card(
-    row: int,
-    column: int,
+    x_start: float,
+    y_start: float,
     data: Dict[str, str],
-    qrcode_pil,
+    qrcode_reader: ImageReader,
     canvas: canvas.Canvas,
     box: bool = False,
-):
-    """
-    Draws a single card
+) -> List[TextRun]:
     """
-    x_start = LABEL_CONFIG["x-start"] + (LABEL_CONFIG["label-width"] * column)
-    y_start = (
-        LABEL_CONFIG["y-start"]
-        + LABEL_CONFIG["label-height"]
-        + (LABEL_CONFIG["label-height"] * row)
-    )
+    Draws a single card.  `x_start` and `y_start` are the top-left corner of
+    the label.
 
+    The text isn't drawn here; it's returned as `(font, size, x, y, text)` runs
+    so the caller can draw the text for the whole page grouped by font.
+    """
     if box:
-        y = y_start - LABEL_CONFIG["label-height"]
-        x = x_start
+        y = y_start - LABEL_CONFIG.label_height
         canvas.rect(
-            height=LABEL_CONFIG["label-height"],
-            width=LABEL_CONFIG["label-width"],
+            height=LABEL_CONFIG.label_height,
+            width=LABEL_CONFIG.label_width,
             x=x_start,
             y=y,
         )
 
-    x_offset = LABEL_CONFIG["x-offset"]
-    y_offset = LABEL_CONFIG["y-offset"]
-    header_offset = 0.3 * inch
-    newline_offset = 0.2 * inch
-    section_offset = 0.5 * inch
-    qrcode_size = 0.9 * inch
+    x_offset = LABEL_CONFIG.x_offset
 
-    x = x_start + x_offset
-
-    pil = ImageReader(qrcode_pil)
     canvas.drawImage(
-        pil, x, y_start - qrcode_size - y_offset, width=qrcode_size, height=qrcode_size
+        qrcode_reader,
+        x_start + x_offset,
+        y_start - QRCODE_SIZE - LABEL_CONFIG.y_offset,
+        width=QRCODE_SIZE,
+        height=QRCODE_SIZE,
     )
 
-    y = y_start - y_offset * 4  # Fudge factor for title string
-    x = x_start + 1.0 * inch
+    y = y_start - TITLE_OFFSET
+    x = x_start + TEXT_INDENT
 
-    canvas.setFont("bold", 14)
-    canvas.drawString(x, y, data["name"])
+    text_runs = [("bold", 14, x, y, data["name"])]
 
-    y -= header_offset
-    canvas.setFont("normal", 14)
-    canvas.drawString(x, y, "SSID:")
+    y -= HEADER_OFFSET
+    text_runs.append(("normal", 14, x, y, "SSID:"))
 
-    y -= newline_offset
-    canvas.setFont("mono", 14)
-    canvas.drawString(x, y, data["ssid"])
+    y -= NEWLINE_OFFSET
+    text_runs.append(("mono", 14, x, y, data["ssid"]))
 
     # Left-align the password section
     x = x_start + x_offset
-    y -= section_offset
-    canvas.setFont("normal", 14)
-    canvas.drawString(x, y, "Password:")
+    y -= SECTION_OFFSET
+    text_runs.append(("normal", 14, x, y, "Password:"))
+
+    y -= NEWLINE_OFFSET
+    size = fit_text_to_width(data["password"], PASSWORD_WIDTH, "mono", 14)
+    text_runs.append(("mono", size, x, y, data["password"]))
 
-    y -= newline_offset
-    width = LABEL_CONFIG["label-width"] - (2 * x_offset)
-    size = fit_text_to_width(data["password"], width, "mono", 14)
-    canvas.setFont("mono", size)
-    canvas.drawString(x, y, data["password"])
+    return text_runs
 
 
-def generate_map(coords: Iterable, wifi_data: List[Dict]) -> Dict[tuple, Dict]:
+def draw_text(canvas: canvas.Canvas, text_runs: List[TextRun]):
     """
-    Create a list of coordinates and the wifi data to use.
+    Draws the text runs ordered by font so the font only changes when needed.
 
-    Returns a generator with only valid coordinates.
+    Everything goes into a single text object (one BT/ET block) rather than a
+    separate block per `drawString` call.
     """
-    wifi_data_mapping: Dict[tuple, Dict] = {x: {} for x in coords}
+    text_object = canvas.beginText()
+    current_font = None
+    for font, size, x, y, text in sorted(text_runs, key=lambda run: run[:2]):
+        if (font, size) != current_font:
+            text_object.setFont(font, size)
+            current_font = (font, size)
+        text_object.setTextOrigin(x, y)
+        text_object.textOut(text)
+
+    canvas.drawText(text_object)
 
-    default_network = None
+
+def generate_map(coords: Iterable, wifi_data: List[Dict]) -> List[Tuple[tuple, Dict]]:
+    """
+    Create a list of coordinates and the wifi data to use.
+
+    Only coordinates that have a network assigned are returned.
+    """
     default_networks = [x for x in wifi_data if "coords" not in x]
     if len(default_networks) > 1:
         raise ValueError(
             "Only one wifi network is allowed to use default coords.  You must specify `coords` on more or more networks"
         )
-    elif len(default_networks) == 1:
-        default_network = default_networks[0]
-
-    # Go through each item that has explicit coordinates
-    specific_networks = (x for x in wifi_data if "coords" in x)
-    for network in specific_networks:
-        for coord in network["coords"]:
-            wifi_data_mapping[tuple(coord)] = network
+    default_network = default_networks[0] if default_networks else None
+
+    # Networks with explicit coordinates take precedence over the default.
+    specific_networks = {
+        tuple(coord): network
+        for network in wifi_data
+        if "coords" in network
+        for coord in network["coords"]
+    }
+
+    wifi_data_mapping = []
+    for coord in coords:
+        network = specific_networks.get(coord, default_network)
+        if network:
+            wifi_data_mapping.append((coord, network))
 
-    # Fill in the blanks with the default network, if any.
-    if default_network:
-        for x in [x for x in wifi_data_mapping if not wifi_data_mapping[x]]:
-            wifi_data_mapping[x] = default_network
+    return wifi_data_mapping
 
-    # Filter out everything that wasn't defined above.
-    return filter_network_map(wifi_data_mapping)
 
+def qrcode_key(network: Dict[str, str]) -> Tuple[str, str, str]:
+    """Returns the network fields that determine its QR code."""
+    return (network["ssid"], network["password"], network["encryption_type"])
 
-def filter_network_map(wifi_data_mapping):
-    """A generator function that only yields valid network info."""
-    for coords, network in wifi_data_mapping.items():
-        if network:
-            yield (coords, network)
 
-
-def generate_pdf(wifi_data: List[Dict], outfile: str, draw_boxes: bool = False):
+def generate_pdf(
+    wifi_data: List[Dict], outfile: Union[str, IO[bytes]], draw_boxes: bool = False
+):
     """
     Generates the PDF by iterating over the columns and rows based on the data.
+
+    `outfile` may be a path or a writable binary file-like object.
     """
-    pdf_canvas = canvas.Canvas(outfile, pagesize=LABEL_CONFIG["pagesize"])
+    pdf_canvas = canvas.Canvas(
+        outfile, pagesize=LABEL_CONFIG.pagesize, pageCompression=1
+    )
     pdf_canvas.setTitle("WiFi Business Cards")
-    all_rows = range(LABEL_CONFIG["rows"])
-    all_columns = range(LABEL_CONFIG["columns"])
+    all_rows = range(LABEL_CONFIG.rows)
+    all_columns = range(LABEL_CONFIG.columns)
+
+    # The top-left corner of every label only depends on its row or column.
+    x_starts = [
+        LABEL_CONFIG.x_start + (LABEL_CONFIG.label_width * column)
+        for column in all_columns
+    ]
+    y_starts = [
+        LABEL_CONFIG.y_start
+        + LABEL_CONFIG.label_height
+        + (LABEL_CONFIG.label_height * row)
+        for row in all_rows
+    ]
 
     all_coords = product(all_rows, all_columns)
     coord_map = generate_map(all_coords, wifi_data)
 
+    # Encode every distinct network's QR code up front; cards for the same
+    # network share the identical image.
+    qrcodes = {
+        key: ImageReader(get_qrcode_pil(*key))
+        for key in {qrcode_key(network) for _, network in coord_map}
+    }
+
+    text_runs: List[TextRun] = []
     for coord, network in coord_map:
-        qrcode = get_qrcode_pil(
-            ssid=network["ssid"],
-            password=network["password"],
-            encryption_type=network["encryption_type"],
-        )
         row, column = coord
-        draw_card(row, column, network, qrcode, pdf_canvas, box=draw_boxes)
+        text_runs += draw_card(
+            x_starts[column],
+            y_starts[row],
+            network,
+            qrcodes[qrcode_key(network)],
+            pdf_canvas,
+            box=draw_boxes,
+        )
 
+    draw_text(pdf_canvas, text_runs)
     pdf_canvas.save()
 
 
+def generate_pdf_bytes(wifi_data: List[Dict], draw_boxes: bool = False) -> bytes:
+    """
+    Generates the PDF in memory and returns its contents.
+    """
+    buffer = io.BytesIO()
+    generate_pdf(wifi_data, buffer, draw_boxes=draw_boxes)
+    return buffer.getvalue()
+
+
 @app.command()
 def main(datafile: str, outfile: str, draw_boxes: bool = False):
     register_fonts()